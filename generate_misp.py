@@ -2,6 +2,10 @@
 
 import requests
 import json
+import os
+import hashlib
+import tempfile
+import heapq
 from collections import defaultdict
 import datetime
 from calendar import monthrange, day_name
@@ -18,6 +22,12 @@ AUTHKEY = misp_conf['authkey']
 HOST_ORG = misp_conf['MISP.host_org']
 GEOLOCATION_PATH = all_conf['geolocation_path']
 START_YEAR = all_conf['start_year']
+LOGIN_MEMORY_BUDGET = all_conf.get('login_memory_budget', 0)
+SPILL_DIR = all_conf.get('spill_dir')
+BYTES_PER_LOGIN_PAIR = 256 # rough in-memory footprint of a (bucket, user) pair
+RUNS_PER_LEVEL = 16 # spilled runs of the same level merged together into a run of the next level
+LOG_PAGE_LIMIT = misp_conf.get('log_page_limit', 10000)
+MANIFEST_FILENAME = 'data-misp-manifest.json'
 HEADERS = {
     'Authorization': AUTHKEY,
     'Accept': 'application/json',
@@ -47,55 +57,161 @@ def print_duration():
     global TIMER
     print(f' Took {int(time.time() - TIMER)} secondes')
 
-def fetch_data():
+def fetch_log_pages(model, action, fromYear=START_YEAR):
     endpoint = '/admin/logs/index'
-    userData = {
-        "model": "User",
-        "action": "add"
-    }
+    page = 1
+    previousBounds = None
+    while True:
+        userData = {
+            "model": model,
+            "action": action,
+            "created": int(datetime.datetime(fromYear, 1, 1).timestamp()),
+            "page": page,
+            "limit": LOG_PAGE_LIMIT,
+        }
+        r = requests.post(BASE_URL + endpoint, data=json.dumps(userData), headers=HEADERS)
+        entries = r.json()
+        del r
+        if len(entries) == 0:
+            break
+        bounds = (entries[0]['Log']['id'], entries[-1]['Log']['id'])
+        if bounds == previousBounds:
+            raise RuntimeError(f'{model}/{action} logs returned the same page twice, paging is not supported by {BASE_URL}')
+        previousBounds = bounds
+        # The `created` filter should leave nothing older than fromYear. If it is ignored, only stop early
+        # when the page is sorted newest first, otherwise the following pages may still hold open years
+        isDescending = entries[0]['Log']['created'] >= entries[-1]['Log']['created']
+        isLastPage = len(entries) < LOG_PAGE_LIMIT or (isDescending and int(entries[-1]['Log']['created'][:4]) < fromYear)
+        yield entries
+        # Only keep one page in memory at a time
+        del entries
+        if isLastPage:
+            break
+        page += 1
+
+def fetch_log(model, action, fromYear=START_YEAR):
+    return [entry for entries in fetch_log_pages(model, action, fromYear) for entry in entries]
+
+def fetch_data(fromYear=START_YEAR):
     log('Collecting user data')
     start_timer()
-    r = requests.post(BASE_URL + endpoint, data=json.dumps(userData), headers=HEADERS)
+    userResponse = fetch_log('User', 'add', fromYear)
     print_duration()
-    userResponse = r.json()
 
-    endpoint = '/admin/logs/index'
-    userData = {
-        "model": "Organisation",
-        "action": "add"
-    }
     log('Collecting organisation data')
     start_timer()
-    r = requests.post(BASE_URL + endpoint, data=json.dumps(userData), headers=HEADERS)
-    print_duration()
-    orgsResponse = r.json()
-
-    endpoint = '/admin/logs/index'
-    userData = {
-        "model": "User",
-        "action": "login"
-    }
-    log('Collecting login data')
-    start_timer()
-    r = requests.post(BASE_URL + endpoint, data=json.dumps(userData), headers=HEADERS)
+    orgsResponse = fetch_log('Organisation', 'add', fromYear)
     print_duration()
-    loginResponse = r.json()
 
     data = {
         'users': userResponse,
         'orgs': orgsResponse,
-        'login': loginResponse,
+        # Login pages are fetched while they are compiled
+        'login': fetch_log_pages('User', 'login', fromYear),
     }
     return data
 
-def compile_data(rawData):
+class DistinctUserCounter:
+    """Collect distinct (bucket, user) pairs, keeping the value of the first occurrence.
+
+    Past `budget` MiB the pairs gathered so far are sorted and spilled to a temporary
+    file. Every `RUNS_PER_LEVEL` runs of the same level are merged into one run of the
+    next level, which bounds the open files and rewrites each pair once per level.
+    `distinct` then merges the remaining runs so that counts stay exact.
+    """
+
+    def __init__(self, budget=0):
+        self.maxPairs = budget * 1024 * 1024 // BYTES_PER_LOGIN_PAIR if budget > 0 else 0
+        self.pairs = defaultdict(dict)
+        self.size = 0
+        # (level, file) in input order, levels never increase towards the end
+        self.runs = []
+        self.spilledPairs = 0
+        self.spilledBytes = 0
+        self.spilledRuns = 0
+
+    def add(self, bucket, user, value=''):
+        users = self.pairs[bucket]
+        if user in users:
+            return
+        users[user] = value
+        self.size += 1
+        if self.maxPairs and self.size >= self.maxPairs:
+            self.spill()
+
+    def sortedPairs(self):
+        for bucket in sorted(self.pairs.keys()):
+            users = self.pairs[bucket]
+            for user in sorted(users.keys()):
+                yield bucket, user, users[user]
+
+    def spill(self):
+        run = self.writeRun(self.sortedPairs())
+        self.spilledPairs += self.size
+        self.spilledBytes += run.tell()
+        self.spilledRuns += 1
+        run.seek(0)
+        self.runs.append((0, run))
+        self.pairs = defaultdict(dict)
+        self.size = 0
+        self.compactRuns()
+
+    def writeRun(self, pairs):
+        run = tempfile.TemporaryFile(mode='w+', dir=SPILL_DIR)
+        for bucket, user, value in pairs:
+            run.write(f'{bucket}\t{user}\t{value}\n')
+        return run
+
+    def readRun(self, run):
+        for line in run:
+            bucket, user, value = line.rstrip('\n').split('\t')
+            yield bucket, user, value
+
+    def tagRun(self, index, run):
+        for bucket, user, value in run:
+            yield bucket, user, index, value
+
+    def mergeRuns(self, runs):
+        # Runs are written in input order, on ties the lowest run index holds the first occurrence
+        tagged = [self.tagRun(index, run) for index, run in enumerate(runs)]
+        previous = None
+        for bucket, user, _, value in heapq.merge(*tagged):
+            if (bucket, user) == previous:
+                continue
+            previous = (bucket, user)
+            yield bucket, user, value
+
+    def compactRuns(self):
+        # Only contiguous runs are merged, so the merged run keeps their place in the input order
+        while len(self.runs) >= RUNS_PER_LEVEL:
+            tail = self.runs[-RUNS_PER_LEVEL:]
+            level = tail[0][0]
+            if tail[-1][0] != level:
+                break
+            merged = self.writeRun(self.mergeRuns([self.readRun(run) for _, run in tail]))
+            merged.seek(0)
+            for _, run in tail:
+                run.close()
+            self.runs[-RUNS_PER_LEVEL:] = [(level + 1, merged)]
+
+    def distinct(self):
+        runs = [self.readRun(run) for _, run in self.runs]
+        for bucket, _, value in self.mergeRuns(runs + [self.sortedPairs()]):
+            yield bucket, value
+        for _, run in self.runs:
+            run.close()
+        self.runs = []
+
+
+def compile_data(rawData, today, fromYear=START_YEAR):
+    # Entries newer than `today` were logged during the fetch, they belong to the next run
     log('Compiling user data')
     start_timer()
     userCreation = defaultdict(int)
     for entry in rawData['users']:
         entry = entry['Log']
         dateYearStr = entry['created'][:4]
-        if int(dateYearStr) < START_YEAR:
+        if int(dateYearStr) < fromYear or int(dateYearStr) > today.year:
             continue
         dateStr = entry['created'][:7]
         userCreation[dateStr] += 1
@@ -109,7 +225,7 @@ def compile_data(rawData):
     for entry in rawData['orgs']:
         entry = entry['Log']
         dateYearStr = entry['created'][:4]
-        if int(dateYearStr) < START_YEAR:
+        if int(dateYearStr) < fromYear or int(dateYearStr) > today.year:
             continue
         dateStr = entry['created'][:7]
         orgAllCreation[dateStr] += 1
@@ -119,56 +235,54 @@ def compile_data(rawData):
             orgKnownCreation[dateStr] += 1
 
     print_duration()
-    log('Compiling login data')
+    log('Collecting and compiling login data')
     start_timer()
-    today = datetime.date.today()
     userLoginMonth = defaultdict(int)
-    userLoginMonthName = defaultdict(set)
     userLoginDay = defaultdict(int)
-    userLoginDayName = defaultdict(set)
     userLoginYearCountry = defaultdict(lambda: defaultdict(int))
-    userLoginYearCountryName = defaultdict(set)
     userLoginHour = {
         year: {
             day: {
                 h: 0 for h in range(0, 24)
             } for day in day_name
-        } for year in range(START_YEAR, today.year+1)
-    }
-    userLoginHourName = {
-        year: {
-            day: set() for day in day_name
-        } for year in range(START_YEAR, today.year+1)
+        } for year in range(fromYear, today.year+1)
     }
-    for entry in rawData['login']:
-        entry = entry['Log']
-    
-        dateYearStr = entry['created'][:4]
-        if int(dateYearStr) < START_YEAR:
-            continue
-        if entry['model_id'] not in userLoginYearCountry[dateYearStr]:
-            ip = entry['ip'].split(',')[0]
-            country = getCountryFromIp(ip)
-            userLoginYearCountry[dateYearStr][country] += 1
-            userLoginYearCountryName[dateYearStr].add(entry['model_id'])
-    
-        dateStr = entry['created'][:10]
-        if entry['model_id'] not in userLoginDayName[dateStr]:
-            userLoginDay[dateStr] += 1
-            userLoginDayName[dateStr].add(entry['model_id'])
-
-        dateStrMonth = entry['created'][:7]
-        if entry['model_id'] not in userLoginMonthName[dateStrMonth]:
-            userLoginMonth[dateStrMonth] += 1
-            userLoginMonthName[dateStrMonth].add(entry['model_id'])
-
-        date = datetime.datetime.fromisoformat(entry['created'])
-        dayName = day_name[date.weekday()]
-        if entry['model_id'] not in userLoginHourName[date.year][dayName]:
-            userLoginHour[date.year][dayName][date.hour] += 1
-            userLoginHourName[date.year][dayName].add(entry['model_id'])
-
-    for y in range(START_YEAR, today.year+1):
+    distinctLogins = DistinctUserCounter(LOGIN_MEMORY_BUDGET)
+    for logins in rawData['login']:
+        for entry in logins:
+            entry = entry['Log']
+
+            dateYearStr = entry['created'][:4]
+            if int(dateYearStr) < fromYear or int(dateYearStr) > today.year:
+                continue
+            if entry['model_id'] not in userLoginYearCountry[dateYearStr]:
+                ip = entry['ip'].split(',')[0]
+                country = getCountryFromIp(ip)
+                userLoginYearCountry[dateYearStr][country] += 1
+
+            user = str(entry['model_id'])
+            distinctLogins.add(f"day|{entry['created'][:10]}", user)
+            distinctLogins.add(f"month|{entry['created'][:7]}", user)
+
+            date = datetime.datetime.fromisoformat(entry['created'])
+            dayName = day_name[date.weekday()]
+            distinctLogins.add(f'hour|{date.year}|{dayName}', user, date.hour)
+        # Drop the page before the next one is fetched
+        del logins
+
+    for bucket, hour in distinctLogins.distinct():
+        kind, _, key = bucket.partition('|')
+        if kind == 'day':
+            userLoginDay[key] += 1
+        elif kind == 'month':
+            userLoginMonth[key] += 1
+        else:
+            year, dayName = key.split('|')
+            userLoginHour[int(year)][dayName][int(hour)] += 1
+    if distinctLogins.spilledPairs > 0:
+        log(f' Spilled {distinctLogins.spilledPairs} login pairs ({distinctLogins.spilledBytes // 1024} KiB) in {distinctLogins.spilledRuns} runs')
+
+    for y in range(fromYear, today.year+1):
         for m in range(1, 13):
             if y == today.year and m == today.month+1:
                 break
@@ -195,18 +309,115 @@ def compile_data(rawData):
     return data
 
 
-def writeOnDisk(data):
-    filename = 'data-misp' + '.json'
-    j = data
-    with open(DIR+filename, 'w') as f:
-        json.dump(j, f)
-    return filename
+def partitionFilename(year, digest):
+    return f'data-misp-{year}-{digest[:8]}.json'
+
+
+def hashContent(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def writeAtomically(path, content):
+    # Write next to the destination and rename so readers never see a truncated file
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, path)
+    except BaseException:
+        os.unlink(tmpPath)
+        raise
+
+
+def loadManifest():
+    path = DIR + MANIFEST_FILENAME
+    if not os.path.exists(path):
+        return {'partitions': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def getFrozenYears(manifest):
+    frozenYears = set()
+    for year, partition in manifest['partitions'].items():
+        if not partition['frozen']:
+            continue
+        path = DIR + partition['filename']
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            if hashContent(f.read()) == partition['sha256']:
+                frozenYears.add(int(year))
+    return frozenYears
+
+
+def getFirstYearToCompile(manifest):
+    frozenYears = getFrozenYears(manifest)
+    year = START_YEAR
+    while year in frozenYears:
+        year += 1
+    return year
+
+
+def partitionData(data, years):
+    partitions = {
+        year: {
+            key: {} for key in data.keys()
+        } for year in years
+    }
+    for key, values in data.items():
+        for date, value in values.items():
+            year = int(str(date)[:4])
+            partitions[year][key][date] = value
+    return partitions
+
+
+def writeOnDisk(data, manifest, today, fromYear=START_YEAR):
+    partitions = partitionData(data, range(fromYear, today.year+1))
+    # Partitions get a new name when their content changes, replacing the manifest is the only commit step
+    for year, partition in partitions.items():
+        content = json.dumps(partition, sort_keys=True).encode()
+        digest = hashContent(content)
+        filename = partitionFilename(year, digest)
+        writeAtomically(DIR+filename, content)
+        manifest['partitions'][str(year)] = {
+            'filename': filename,
+            'sha256': digest,
+            'frozen': year < today.year,
+        }
+    manifest['partitions'] = {
+        year: partition for year, partition in sorted(manifest['partitions'].items()) if int(year) >= START_YEAR
+    }
+    writeAtomically(DIR+MANIFEST_FILENAME, json.dumps(manifest, indent=2).encode())
+    removeUnlistedPartitions(manifest)
+    return MANIFEST_FILENAME
+
+
+def removeUnlistedPartitions(manifest):
+    # Also removes the data-misp.json written by earlier versions
+    listed = set(partition['filename'] for partition in manifest['partitions'].values())
+    for filename in os.listdir(DIR):
+        if not filename.startswith('data-misp') or not filename.endswith('.json'):
+            continue
+        if filename == MANIFEST_FILENAME or filename in listed:
+            continue
+        log(f'Removing {filename}')
+        os.remove(DIR + filename)
 
 
 def generate():
-    rawData = fetch_data()
-    data = compile_data(rawData)
-    filename = writeOnDisk(data)
+    manifest = loadManifest()
+    fromYear = getFirstYearToCompile(manifest)
+    if fromYear > START_YEAR:
+        log(f'Reusing frozen partitions from {START_YEAR} to {fromYear-1}')
+    # Taken before fetching so that a year is only frozen from data fetched after it closed
+    today = datetime.date.today()
+    rawData = fetch_data(fromYear)
+    data = compile_data(rawData, today, fromYear)
+    filename = writeOnDisk(data, manifest, today, fromYear)
     return filename
 
 
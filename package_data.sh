@@ -1,3 +1,3 @@
 #!/bin/bash
 
-tar czvf exposed/data.tar.gz data
+tar czvf exposed/data.tar.gz --exclude='.tmp-*' data
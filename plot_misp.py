@@ -4,6 +4,8 @@ from calendar import day_name
 import json
 from collections import defaultdict
 import datetime
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 from math import pi
@@ -17,7 +19,7 @@ from bokeh.models.formatters import FuncTickFormatter
 from bokeh.models.ranges import Range1d
 from bokeh.layouts import column
 import bokeh.palettes as all_palettes
-from bokeh.embed import file_html
+from bokeh.embed import file_html, json_item
 
 from bokeh.resources import CDN, JSResources, CSSResources
 from jinja2 import Template
@@ -28,6 +30,7 @@ from config import all as all_config
 DIRDATA = misp_conf['DIR']
 DIRHTML = misp_conf['DIR_HTML']
 MISPBASEURL = misp_conf['baseurl']
+PLOT_PROCESSES = all_config.get('plot_processes', 1)
 
 TEXT_HEADING = 'MISP Usage Statistics'
 TEXT_DOWNDLOAD = '<a href="{}" download id="download">{}</a>'.format(all_config['stat_download_location'], 'Download MISP statistics')
@@ -239,18 +242,20 @@ def bokehPlotHeatMapLoginPerHour(dfLogin, title=""):
     p.add_layout(color_bar, 'right')
     return p
 
+def getTopCountries(x, topAmount=12):
+    filteredX = [(k, v) for k, v in x.items() if v > 0 and k != 'null']
+    filteredX.sort(key=lambda x: x[1], reverse=True)
+    topX = {k: v for k, v in filteredX[:topAmount]}
+    topX['Others'] = sum([t[1] for t in filteredX[topAmount:]])
+    return topX
+
 def bokehPlotPie(
         x={},
         title="Ticket Classification",
         legendTitle='',
     ):
 
-    topAmount = 12
-    filteredX = [(k, v) for k, v in x.items() if v > 0 and k != 'null']
-    filteredX.sort(key=lambda x: x[1], reverse=True)
-    topX = {k: v for k, v in filteredX[:topAmount]}
-    topX['Others'] = sum([t[1] for t in filteredX[topAmount:]])
-
+    topX = getTopCountries(x)
     data = pd.Series(topX).reset_index(name='value').rename(columns={'index': 'type'})
     data['angle'] = data['value']/data['value'].sum() * 2*pi
     data['color'] = getColorPaletteForCountries(topX)
@@ -342,12 +347,19 @@ def bokehSegment(x, yName, title=''):
 
 
 def collect_data():
-    filename = 'data-misp.json'
+    filename = 'data-misp-manifest.json'
     path = DIRDATA + filename
-    parsed = {}
     with open(path) as f:
-        parsed = json.load(f)
-    return parsed
+        manifest = json.load(f)
+    parsed = defaultdict(dict)
+    for year, partition in sorted(manifest['partitions'].items()):
+        with open(DIRDATA + partition['filename'], 'rb') as f:
+            content = f.read()
+        if hashlib.sha256(content).hexdigest() != partition['sha256']:
+            raise ValueError(f"Partition {partition['filename']} does not match the hash recorded in {filename}")
+        for key, values in json.loads(content).items():
+            parsed[key].update(values)
+    return dict(parsed)
 
 def generateHtml(models, renderJS=True):
     template_name = 'basic.j2'
@@ -370,6 +382,25 @@ def generateHtml(models, renderJS=True):
     return html
 
 
+def generateHtmlItems(layout, items, renderJS=True):
+    template_name = 'items.j2'
+    with open(template_name, 'r') as template_f:
+        template_content = template_f.read()
+    the_template = Template(template_content)
+    js_resources = JSResources(mode="inline", minified=True, components=["bokeh"])
+    # Escape closing tags so that the serialized items cannot terminate the script element
+    items_json = json.dumps(items).replace('</', '<\\/')
+    html = the_template.render(
+        layout=layout,
+        items_json=items_json,
+        js_data=js_resources.render_js() if renderJS else '',
+        text_heading=TEXT_HEADING,
+        text_download=TEXT_DOWNDLOAD,
+        text_footing=TEXT_FOOTING,
+    )
+    return html
+
+
 def writeHtml(html):
     path = DIRHTML + 'plot-bokeh-misp.html'
     with open(path, 'w') as f:
@@ -377,8 +408,7 @@ def writeHtml(html):
     return path
 
 
-def plot():
-    data = collect_data()
+def prepareCharts(data):
     dates = list(data['users'].keys())
     dates.sort()
     today = datetime.date.today()
@@ -418,10 +448,12 @@ def plot():
     userPerYear = dict(userPerYear)
     orgsAllPerYear = dict(orgsAllPerYear)
 
-    user_overtime = plotOvertime(dates, usersOvertime, y_year=userPerYear, title=f"New User on MISP ({MISPBASEURL}) over time", y_label='New User', y_year_label='New User per Year')
-    user_cumulative_overtime = plotOvertime(dates, usersCumuOvertime, y_year=False, title=f"Cumulative Users on MISP ({MISPBASEURL}) over time", y_label='Cumulative New User')
-    org_overtime = plotStackedOvertime(dates, orgsLocalOvertime, orgsKnownOvertime, title=f"New Organisations on MISP ({MISPBASEURL}) over time", y_label='New Organisation')
-    org_cumulative_overtime = plotOvertime(dates, orgsAllCumuOvertime, y_year=False, title=f"Cumulative Organisations on MISP ({MISPBASEURL}) over time", y_label='Cumulative New Organisation')
+    charts = [
+        (plotOvertime, (dates, usersOvertime), {'y_year': userPerYear, 'title': f"New User on MISP ({MISPBASEURL}) over time", 'y_label': 'New User', 'y_year_label': 'New User per Year'}),
+        (plotOvertime, (dates, usersCumuOvertime), {'y_year': False, 'title': f"Cumulative Users on MISP ({MISPBASEURL}) over time", 'y_label': 'Cumulative New User'}),
+        (plotStackedOvertime, (dates, orgsLocalOvertime, orgsKnownOvertime), {'title': f"New Organisations on MISP ({MISPBASEURL}) over time", 'y_label': 'New Organisation'}),
+        (plotOvertime, (dates, orgsAllCumuOvertime), {'y_year': False, 'title': f"Cumulative Organisations on MISP ({MISPBASEURL}) over time", 'y_label': 'Cumulative New Organisation'}),
+    ]
 
     allMonthNames = [datetime.date(2022, m, 1).strftime('%b') for m in range(1, 13)]
     allNames = ['Year'].append(allMonthNames)
@@ -437,7 +469,9 @@ def plot():
         yearIndex = year - startYear
         dataHeatmap[monthName][yearIndex] = amount
     dfLogin = pd.DataFrame.from_dict(dataHeatmap, columns=allNames)
-    login_overtime = bokehPlotHeatMapLoginPerMonth(dfLogin, title=f"Heatmap of manual unique logins on MISP ({MISPBASEURL})")
+    charts.append((bokehPlotHeatMapLoginPerMonth, (dfLogin,), {'title': f"Heatmap of manual unique logins on MISP ({MISPBASEURL})"}))
+    # A section is a list of (tab title, chart), a standalone chart has no title
+    sections = [[(None, chart)] for chart in charts]
 
     dataLoginPerHourOverYear = {
         year: {
@@ -456,28 +490,77 @@ def plot():
         hasLoginForThatYear = len([l for l in [dataLoginPerHourOverYear[year][d] for d in day_name] if sum(l) > 0]) > 0
         if hasLoginForThatYear:
             dfLogin = pd.DataFrame.from_dict(dataLoginPerHourOverYear[year], columns=allNames)
-            login_per_hour = bokehPlotHeatMapLoginPerHour(dfLogin, title=f"Heatmap of manual unique logins on MISP ({MISPBASEURL})")
-            panel = Panel(child=login_per_hour, title=str(year))
-            charts_login_per_hour.append(panel)
-    tabs_login_per_hour = Tabs(tabs=charts_login_per_hour[::-1])
+            login_per_hour = (bokehPlotHeatMapLoginPerHour, (dfLogin,), {'title': f"Heatmap of manual unique logins on MISP ({MISPBASEURL})"})
+            charts_login_per_hour.append((str(year), login_per_hour))
+    sections.append(charts_login_per_hour[::-1])
 
     charts_loging_country_per_year = []
     for year in allYears:
         yearlyData = data['login_country'].get(str(year), {})
         total = sum(yearlyData.values())
         if total > 0:
-            login_country = bokehPlotPie(yearlyData, title=f"Manual unique logins per country on MISP ({MISPBASEURL})", legendTitle=f"Total number of unique login {total}")
-            panel = Panel(child=login_country, title=str(year))
-            charts_loging_country_per_year.append(panel)
-    tabs_login_country = Tabs(tabs=charts_loging_country_per_year[::-1])
+            # Colors are assigned on first use, reserve them here so that charts built in other processes agree
+            getColorPaletteForCountries(getTopCountries(yearlyData))
+            login_country = (bokehPlotPie, (yearlyData,), {'title': f"Manual unique logins per country on MISP ({MISPBASEURL})", 'legendTitle': f"Total number of unique login {total}"})
+            charts_loging_country_per_year.append((str(year), login_country))
+    sections.append(charts_loging_country_per_year[::-1])
+
+    return sections
+
+
+def buildChart(chart):
+    builder, args, kwargs = chart
+    return builder(*args, **kwargs)
+
+
+def buildSection(section):
+    if len(section) == 1 and section[0][0] is None:
+        return buildChart(section[0][1])
+    panels = [Panel(child=buildChart(chart), title=title) for title, chart in section]
+    return Tabs(tabs=panels)
+
+
+def initWorker(colors):
+    assignedColors.update(colors)
 
-    columns = column(user_overtime, user_cumulative_overtime, org_overtime, org_cumulative_overtime, login_overtime, tabs_login_per_hour, tabs_login_country, spacing=42)
+
+def renderChartItem(chart, target):
+    return json_item(buildChart(chart), target)
+
+
+def plot():
+    data = collect_data()
+    charts = [buildSection(section) for section in prepareCharts(data)]
+    columns = column(*charts, spacing=42)
     return columns
 
 
+def plotItems(processes):
+    data = collect_data()
+    # Every chart, including each year of a tab set, is its own task. The template rebuilds the tabs
+    charts = []
+    targets = []
+    layout = []
+    for i, section in enumerate(prepareCharts(data)):
+        entries = []
+        for j, (title, chart) in enumerate(section):
+            target = f'misp-chart-{i}-{j}'
+            charts.append(chart)
+            targets.append(target)
+            entries.append({'title': title, 'target_id': target})
+        layout.append(entries)
+    with ProcessPoolExecutor(max_workers=processes, initializer=initWorker, initargs=(dict(assignedColors),)) as executor:
+        items = list(executor.map(renderChartItem, charts, targets))
+    return layout, items
+
+
 def main():
-    chart = plot()
-    html = generateHtml(chart)
+    if PLOT_PROCESSES > 1:
+        layout, items = plotItems(PLOT_PROCESSES)
+        html = generateHtmlItems(layout, items)
+    else:
+        chart = plot()
+        html = generateHtml(chart)
     path = writeHtml(html)
     print(path)
 